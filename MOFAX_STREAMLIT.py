@@ -1,47 +1,97 @@
 import streamlit as st
 import mofax as mfx
-import plotly.express as px
 import pandas as pd
 import matplotlib.pyplot as plt
 import tempfile
+import hashlib
+import os
+import shutil
 import warnings
 import numpy as np
 import seaborn as sns
-from gprofiler import GProfiler
-def process_mofa_weights(model):
-    weights = model.get_weights()
-    weights_df = pd.DataFrame(weights)
-    return weights_df
+
+UPLOAD_COPY_BUFFER_BYTES = 8 * 1024 * 1024
+ENRICHMENT_PLOT_CACHE_ENTRIES = 64
+# Per-model caches: every distinct upload would otherwise stay in memory for the life of the process
+MODEL_CACHE_ENTRIES = 8
+MODEL_CACHE_TTL = 3600
+
+@st.cache_resource(ttl=MODEL_CACHE_TTL, max_entries=MODEL_CACHE_ENTRIES)
+def load_model(path):
+    return mfx.mofa_model(path)
+
+@st.cache_data(ttl=MODEL_CACHE_TTL, max_entries=MODEL_CACHE_ENTRIES)
+def load_weights_df(path):
+    return load_model(path).get_weights(df=True)
+
+@st.cache_data(ttl=MODEL_CACHE_TTL, max_entries=MODEL_CACHE_ENTRIES)
+def load_variance_df(path):
+    return load_model(path).calculate_variance_explained()
+
+@st.cache_data
+def load_top_features(path, n_features):
+    return get_top_features(load_weights_df(path), n_features=n_features)
+
+@st.cache_data(ttl=3600)
+def load_enrichment(path, n_features):
+    return run_enrichment(load_top_features(path, n_features))
+
+@st.cache_data(ttl=3600)
+def load_factor_enrichment(path, n_features, factor):
+    return run_enrichment({factor: load_top_features(path, n_features)[factor]})
+
+@st.cache_resource(ttl=MODEL_CACHE_TTL, max_entries=MODEL_CACHE_ENTRIES)
+def load_weights_heatmap(path, n_features):
+    fig = mfx.plot_weights_heatmap(load_model(path), n_features=n_features).figure
+    fig.tight_layout()
+    # Detach the shared figure from pyplot so st.pyplot() calls without a figure can't draw into or clear it
+    plt.close(fig)
+    return fig
+
+@st.cache_resource(ttl=3600, max_entries=ENRICHMENT_PLOT_CACHE_ENTRIES)
+def load_enrichment_plot(factor, top_n, results_key, _results):
+    # _results is not hashed; results_key identifies its contents
+    fig = plot_enrichment(factor, _results, top_n=top_n)
+    if fig:
+        # Drop pyplot's reference so the figure is freed once evicted from the cache
+        plt.close(fig)
+    return fig
+
+@st.cache_data(ttl=MODEL_CACHE_TTL, max_entries=MODEL_CACHE_ENTRIES)
+def to_csv_bytes(df_key, _df):
+    # Only df_key is hashed; hashing the frame itself would cost as much as the export
+    return _df.to_csv(index=False).encode('utf-8')
 
 def get_top_features(weights_df, n_features=50):
+    abs_weights = np.abs(weights_df.to_numpy())
+    n_rows = abs_weights.shape[0]
+    n_features = min(n_features, n_rows)
     top_features = {}
     for factor in range(weights_df.shape[1]):
-        abs_weights = np.abs(weights_df.iloc[:, factor])
-        top_indices = abs_weights.nlargest(n_features).index
-        top_features[f"Factor_{factor+1}"] = top_indices.tolist()
+        col = abs_weights[:, factor]
+        # Partial sort for the n-th largest |weight|; ties at the cut go to the earliest rows,
+        # and ties within the selection are ordered by row, matching nlargest(keep='first')
+        cutoff = np.partition(col, n_rows - n_features)[n_rows - n_features]
+        above = np.flatnonzero(col > cutoff)
+        tied = np.flatnonzero(col == cutoff)[:n_features - len(above)]
+        top_indices = np.concatenate([above, tied])
+        top_indices = top_indices[np.lexsort((top_indices, -col[top_indices]))]
+        top_features[f"Factor_{factor+1}"] = weights_df.index[top_indices].tolist()
     return top_features
 
 def run_enrichment(features_dict):
+    from gprofiler import GProfiler
     gp = GProfiler(return_dataframe=True)
-    all_results = []
-    
-    for factor, genes in features_dict.items():
-        try:
-            results = gp.profile(
-                query=genes,
-                organism='hsapiens',
-                sources=['GO:BP', 'KEGG', 'REAC'],
-                user_threshold=0.05
-            )
-            results['factor'] = factor
-            results['neglog10pval'] = -np.log10(results['p_value'])
-            all_results.append(results)
-        except Exception as e:
-            st.error(f"Error in enrichment for {factor}: {str(e)}")
-    
-    if all_results:
-        return pd.concat(all_results, ignore_index=True)
-    return pd.DataFrame()
+    # A dict query runs every factor in one request; each result row's 'query' is its factor
+    results = gp.profile(
+        query=features_dict,
+        organism='hsapiens',
+        sources=['GO:BP', 'KEGG', 'REAC'],
+        user_threshold=0.05
+    )
+    results['factor'] = results['query']
+    results['neglog10pval'] = -np.log10(results['p_value'].astype(float))
+    return results
 
 def plot_enrichment(factor, results, top_n=10):
     if len(results) == 0:
@@ -181,17 +231,24 @@ with st.sidebar:
         model_file = "model_br.hdf5"  
 
 if model_file:
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".hdf5") as tmp_file:
-        if isinstance(model_file, str): 
-            temp_filepath = model_file
-        else:
-            tmp_file.write(model_file.read())
-            temp_filepath = tmp_file.name
+    if isinstance(model_file, str): 
+        temp_filepath = model_file
+    else:
+        # Name the temp file after the upload's content hash so re-uploads and reruns hit the model cache
+        # Hash each upload once per session; widget interactions rerun with the same file_id
+        if st.session_state.get("model_file_id") != model_file.file_id:
+            st.session_state["model_file_hash"] = hashlib.md5(model_file.getbuffer()).hexdigest()
+            st.session_state["model_file_id"] = model_file.file_id
+        file_hash = st.session_state["model_file_hash"]
+        temp_filepath = os.path.join(tempfile.gettempdir(), f"mofa_{file_hash}.hdf5")
+        if not os.path.exists(temp_filepath):
+            model_file.seek(0)
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".hdf5") as tmp_file:
+                shutil.copyfileobj(model_file, tmp_file, length=UPLOAD_COPY_BUFFER_BYTES)
+                tmp_file.flush()
+            os.replace(tmp_file.name, temp_filepath)
 
-    m = mfx.mofa_model(temp_filepath)
-    weights_df = process_mofa_weights(m)
-    top_features = get_top_features(weights_df, n_features=30)
-    enrichment_results = run_enrichment(top_features)
+    m = load_model(temp_filepath)
     col1, col2, col3 = st.columns(3)
     
     with col1:
@@ -217,8 +274,7 @@ if model_file:
         
         with col1:
             if st.button("📥 Weights Data"):
-                weights_df = m.get_weights(df=True)
-                csv = weights_df.to_csv(index=False)
+                csv = to_csv_bytes((temp_filepath, 'weights'), load_weights_df(temp_filepath))
                 st.download_button(
                     label="Download CSV",
                     data=csv,
@@ -228,11 +284,10 @@ if model_file:
         
         with col2:
             if st.button("📊 Variance Data"):
-                variance_df = m.calculate_variance_explained()
-                csv = variance_df.to_csv(index=False)
+                csv = to_csv_bytes((temp_filepath, 'variance'), load_variance_df(temp_filepath))
                 st.download_button(
                     label="Download CSV",
-                    data=variance_df.to_csv(index=False),
+                    data=csv,
                     file_name='variance_explained.csv',
                     mime='text/csv',
                 )
@@ -242,9 +297,7 @@ if model_file:
     with tab1:
         st.markdown("### Top Feature Weights")
         with st.container():
-            ax_weights = mfx.plot_weights_heatmap(m, n_features=10)
-            plt.tight_layout()
-            st.pyplot(ax_weights.figure)
+            st.pyplot(load_weights_heatmap(temp_filepath, n_features=10))
 
     with tab2:
         st.markdown("### Ranked Weights")
@@ -268,7 +321,6 @@ if model_file:
 
     with tab4:
         st.markdown("### Factor Correlation Analysis (Pearson)")
-        correlation_matrix = m.get_weights(df=True).corr()
         mfx.plot_factors_correlation(m)
         plt.title("Pearson r")
         st.pyplot()
@@ -296,10 +348,25 @@ if model_file:
                     help="Select how many enrichment results to display in each factor plot"
                 )
 
+            top_features = load_top_features(temp_filepath, n_features)
+            # Errors are handled here, outside the cached call, so a failed request is not cached
+            try:
+                enrichment_results = load_enrichment(temp_filepath, n_features)
+            except Exception:
+                # Fall back to one request per factor so a single failure does not hide the rest
+                factor_results = []
+                for factor in top_features.keys():
+                    try:
+                        factor_results.append(load_factor_enrichment(temp_filepath, n_features, factor))
+                    except Exception as e:
+                        st.error(f"Error in enrichment for {factor}: {str(e)}")
+                enrichment_results = pd.concat(factor_results, ignore_index=True) if factor_results else pd.DataFrame()
+
             if not enrichment_results.empty:
                 st.subheader("Factor-Specific Enrichment Plots")
+                results_key = pd.util.hash_pandas_object(enrichment_results[['factor', 'native', 'name', 'p_value']], index=False).sum()
                 for factor in top_features.keys():
-                    fig = plot_enrichment(factor, enrichment_results, top_n=top_n_results)
+                    fig = load_enrichment_plot(factor, top_n_results, results_key, enrichment_results)
                     if fig:
                         st.pyplot(fig)
                         st.markdown("---")